@@ -0,0 +1,269 @@
+import os
+import re
+import secrets
+import threading
+from datetime import datetime
+
+from flask import Flask, abort, jsonify, request, send_from_directory
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from werkzeug.utils import secure_filename
+
+from chats import ChatStore
+from friends import FriendGraph
+from storage import (
+    Message, load_users, save_users, users_mtime, generate_nick, get_chat_key, now_timestamp, nick_index
+)
+
+IMAGES_DIR = "images"
+PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 200
+TOKEN_MAX_AGE = 30 * 24 * 3600
+
+def create_app():
+    app = Flask(__name__)
+    # При нескольких процессах ключ обязан быть общим, иначе токены не сойдутся
+    app.secret_key = os.environ.get("FPIERSK_SECRET") or secrets.token_hex(32)
+    app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+    tokens = URLSafeTimedSerializer(app.secret_key, salt="fpiersk-auth")
+    # Один абсолютный путь и для записи, и для отдачи: send_from_directory считает от app.root_path
+    images_dir = os.path.abspath(IMAGES_DIR)
+
+    db_lock = threading.RLock()
+    chats = ChatStore()
+    graph = FriendGraph()
+    with db_lock:
+        chats.load()
+        graph.load()
+        users = load_users()
+        # API может стартовать раньше настольного клиента: переносим старые данные сами
+        migrated = chats.migrate_from_users(users)
+        if graph.migrate_from_users(users):
+            graph.save()
+            migrated = True
+        if migrated:
+            save_users(users)
+        state = {"users": users, "users_mtime": users_mtime(), "nicks": nick_index(users)}
+
+    def get_users():
+        # users.json может менять и настольный клиент, поэтому следим за mtime
+        with db_lock:
+            mtime = users_mtime()
+            if mtime != state["users_mtime"]:
+                state["users"] = load_users()
+                state["users_mtime"] = mtime
+                state["nicks"] = nick_index(state["users"])
+            return state["users"]
+
+    def email_for(nick):
+        get_users()
+        return state["nicks"].get(nick)
+
+    def friend_nicks(email):
+        with db_lock:
+            graph.reload_if_changed()
+            users = get_users()
+            return sorted(users[f]["nick"] for f in graph.friends(email) if f in users)
+
+    def store_users(users):
+        save_users(users)
+        state["users_mtime"] = users_mtime()
+
+    def current_user():
+        header = request.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            abort(401)
+        try:
+            email = tokens.loads(header[7:], max_age=TOKEN_MAX_AGE)
+        except (BadSignature, SignatureExpired):
+            abort(401)
+        user = get_users().get(email)
+        if user is None:
+            abort(401)
+        return email, user
+
+    def member_chat(chat_id, nick):
+        chats.reload_if_changed()
+        conv = chats.get(chat_id)
+        if conv is None or nick not in conv.members:
+            abort(404)
+        return conv
+
+    def open_chat(chat_id, email, nick):
+        # Личный чат с другом создаётся при первом сообщении или вложении
+        with db_lock:
+            chats.reload_if_changed()
+            if chats.get(chat_id) is None:
+                friend = next((f for f in friend_nicks(email) if get_chat_key(nick, f) == chat_id), None)
+                if friend is not None:
+                    chats.direct_chat(nick, friend)
+            return member_chat(chat_id, nick)
+
+    def json_body():
+        # Пустое тело - как пустой объект; JSON не-объект - ошибка клиента, а не 500
+        data = request.get_json(silent=True)
+        if data is None:
+            return {}
+        if not isinstance(data, dict):
+            abort(400)
+        return data
+
+    def error(message, status=400):
+        return jsonify({"error": message}), status
+
+    @app.post("/api/register")
+    def register():
+        data = json_body()
+        email = str(data.get("email", "")).strip()
+        password = str(data.get("password", ""))
+        name = str(data.get("name", "")).strip()
+        if not email or not password or not name:
+            return error("Все поля должны быть заполнены")
+        if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
+            return error("Неверный формат почты")
+        with db_lock:
+            users = get_users()
+            if email in users:
+                return error("Пользователь с такой почтой уже существует", 409)
+            nick = generate_nick(name)
+            users[email] = {"password": password, "nick": nick}
+            store_users(users)
+            state["nicks"][nick] = email
+        return jsonify({"nick": nick}), 201
+
+    @app.post("/api/login")
+    def login():
+        data = json_body()
+        email = str(data.get("email", "")).strip()
+        user = get_users().get(email)
+        if not user or user["password"] != data.get("password"):
+            return error("Неверная почта или пароль", 401)
+        return jsonify({"token": tokens.dumps(email), "nick": user["nick"]})
+
+    @app.get("/api/friends")
+    def friends():
+        email, _ = current_user()
+        return jsonify({"friends": friend_nicks(email)})
+
+    @app.post("/api/friends")
+    def add_friend():
+        email, _ = current_user()
+        nick = str(json_body().get("nick", "")).strip()
+        with db_lock:
+            friend_email = email_for(nick)
+            if friend_email is None:
+                return error("Пользователь с таким ником не найден", 404)
+            if friend_email == email:
+                return error("Нельзя добавить себя")
+            graph.reload_if_changed()
+            if not graph.add(email, friend_email):
+                return error("Пользователь уже в друзьях", 409)
+            graph.save()
+        return jsonify({"friends": friend_nicks(email)}), 201
+
+    @app.delete("/api/friends/<nick>")
+    def remove_friend(nick):
+        email, _ = current_user()
+        with db_lock:
+            friend_email = email_for(nick)
+            graph.reload_if_changed()
+            if friend_email is None or not graph.remove(email, friend_email):
+                return error("Пользователь не в друзьях", 404)
+            graph.save()
+        return jsonify({"friends": friend_nicks(email)})
+
+    @app.get("/api/chats")
+    def chat_list():
+        _, user = current_user()
+        nick = user["nick"]
+        chats.reload_if_changed()
+        chats.load_receipts(nick)  # отметки о прочтении с других устройств
+        # Под замком хранилища список и счётчики берутся из одного и того же состояния
+        with chats.lock:
+            items = [
+                {
+                    "id": conv.id,
+                    "title": conv.title_for(nick),
+                    "group": conv.is_group,
+                    "members": conv.members,
+                    "total": conv.total,
+                    "unread": chats.unread_count(conv.id, nick),
+                }
+                for conv in chats.chats_for(nick)
+            ]
+        return jsonify({"chats": items})
+
+    @app.get("/api/chats/<chat_id>/messages")
+    def history(chat_id):
+        _, user = current_user()
+        conv = member_chat(chat_id, user["nick"])
+        total = conv.total
+        end = max(min(request.args.get("before", total, type=int), total), 0)
+        limit = max(1, min(request.args.get("limit", PAGE_LIMIT, type=int), MAX_PAGE_LIMIT))
+        start = max(end - limit, 0)
+        # История не меняется задним числом, поэтому страница [start, end) неизменна
+        etag = f"{chat_id}:{start}:{end}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        response = jsonify({
+            "start": start,
+            "end": end,
+            "messages": [m.to_dict() for m in chats.page(chat_id, start, end)],
+        })
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = 0 if end == total else 3600
+        return response
+
+    @app.post("/api/chats/<chat_id>/messages")
+    def post_message(chat_id):
+        email, user = current_user()
+        text = str(json_body().get("text", "")).strip()
+        if not text:
+            return error("Пустое сообщение")
+        with db_lock:
+            open_chat(chat_id, email, user["nick"])
+            msg = Message(user["nick"], "text", text, now_timestamp())
+            index = chats.append(chat_id, msg) - 1
+            chats.save()
+        return jsonify({"index": index, "message": msg.to_dict()}), 201
+
+    # Вложения адресуются через переписку: доступ проверяется так же, как к истории
+    @app.post("/api/chats/<chat_id>/attachments")
+    def upload_attachment(chat_id):
+        email, user = current_user()
+        upload = request.files.get("file")
+        if upload is None or not upload.filename:
+            return error("Файл не передан")
+        base, ext = os.path.splitext(secure_filename(upload.filename) or "file")
+        name = f"{base}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}{ext}"
+        with db_lock:
+            # Сначала проверяем доступ к переписке, потом пишем файл на диск
+            open_chat(chat_id, email, user["nick"])
+            os.makedirs(images_dir, exist_ok=True)
+            upload.save(os.path.join(images_dir, name))
+            chats.append(chat_id, Message(user["nick"], "image", os.path.join(IMAGES_DIR, name), now_timestamp()))
+            chats.save()
+        return jsonify({"file": name}), 201
+
+    @app.get("/api/chats/<chat_id>/attachments/<name>")
+    def download_attachment(chat_id, name):
+        _, user = current_user()
+        member_chat(chat_id, user["nick"])
+        # send_from_directory отдаёт файл потоком, с ETag, If-Modified-Since и Range
+        return send_from_directory(images_dir, name, conditional=True, max_age=3600)
+
+    return app
+
+def main():
+    from waitress import serve
+
+    host = os.environ.get("FPIERSK_HTTP_HOST", "0.0.0.0")
+    port = int(os.environ.get("FPIERSK_HTTP_PORT", "8080"))
+    threads = int(os.environ.get("FPIERSK_HTTP_THREADS", "8"))
+    # waitress держит keep-alive соединения и обслуживает запросы пулом потоков
+    serve(create_app(), host=host, port=port, threads=threads)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from storage import messages_from_disk
+
+# Сравнение памяти под историю: словари из json.load против Message.
+# Запуск: python bench_messages.py [число сообщений]
+
+def make_dataset(n_messages):
+    users = {
+        "a@a.a": {"password": "1", "nick": "Alice#0001", "friends": ["Bob#0002"], "messages": {}},
+        "b@b.b": {"password": "1", "nick": "Bob#0002", "friends": ["Alice#0001"], "messages": {}},
+    }
+    nicks = ["Alice#0001", "Bob#0002"]
+    start = 1700000000
+    history = [
+        {
+            "sender": nicks[i % 2],
+            "type": "text",
+            "text": f"сообщение номер {i}",
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start + i // 3)),
+        }
+        for i in range(n_messages)
+    ]
+    for u in users.values():
+        u["messages"]["Alice#0001|Bob#0002"] = history
+    return json.dumps(users, ensure_ascii=False)
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    raw = make_dataset(n)
+
+    as_dicts, dict_size, dict_time = measure(lambda: json.loads(raw))
+    del as_dicts
+    as_records, rec_size, rec_time = measure(lambda: messages_from_disk(json.loads(raw)))
+    del as_records
+
+    print(f"сообщений в переписке: {n} (хранится у обоих пользователей)")
+    print(f"dict:    {dict_size / 2**20:8.1f} МБ, загрузка {dict_time:.2f} с")
+    print(f"Message: {rec_size / 2**20:8.1f} МБ, загрузка {rec_time:.2f} с")
+    print(f"экономия: {(1 - rec_size / dict_size) * 100:.0f}%")
+
+if __name__ == "__main__":
+    main()
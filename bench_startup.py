@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import subprocess
+import tempfile
+
+# Замер времени до первого окна входа при разном размере users.json.
+# Запуск: python bench_startup.py
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SIZES = [0, 1000, 10000, 100000]
+RUNS = 5
+
+CHILD = r"""
+import os, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+from PyQt5.QtWidgets import QApplication
+import client
+t_import = time.perf_counter()
+app = QApplication(sys.argv[:1])
+window = client.LoginRegisterWindow()
+window.show()
+app.processEvents()
+t_shown = time.perf_counter()
+print(f"{t_import - t0:.4f} {t_shown - t0:.4f}")
+"""
+
+def make_users(path, n_messages):
+    users = {
+        "a@a.a": {"password": "1", "nick": "A#0001", "friends": ["B#0002"], "messages": {}},
+        "b@b.b": {"password": "1", "nick": "B#0002", "friends": ["A#0001"], "messages": {}},
+    }
+    key = "A#0001|B#0002"
+    history = [
+        {"sender": "A#0001", "type": "text", "text": f"сообщение {i}", "timestamp": "2024-01-01 12:00:00"}
+        for i in range(n_messages)
+    ]
+    for u in users.values():
+        u["messages"][key] = history
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(users, f, ensure_ascii=False, indent=4)
+
+def run_once(workdir):
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    out = subprocess.check_output(
+        [sys.executable, "-c", CHILD, REPO_DIR], cwd=workdir, env=env, text=True
+    )
+    t_import, t_shown = map(float, out.split()[-2:])
+    return t_import, t_shown
+
+def main():
+    print(f"{'сообщений':>10} {'импорт, мс':>12} {'окно, мс':>10}")
+    for n in SIZES:
+        with tempfile.TemporaryDirectory() as workdir:
+            make_users(os.path.join(workdir, "users.json"), n)
+            results = sorted(run_once(workdir) for _ in range(RUNS))
+            t_import, t_shown = results[len(results) // 2]
+            print(f"{n:>10} {t_import * 1000:>12.1f} {t_shown * 1000:>10.1f}")
+
+if __name__ == "__main__":
+    main()
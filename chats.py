@@ -0,0 +1,346 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+from storage import Message, get_chat_key, file_stamp, write_json_atomic
+
+CHATS_DB = "chats.json"
+HISTORY_DIR = "history"
+RECEIPTS_DIR = "receipts"  # курсоры прочтения: по файлу на пользователя
+
+# В chats.json остаются только последние сообщения каждой переписки.
+# Более старые уходят в сжатые сегменты по SEGMENT_SIZE сообщений,
+# которые читаются с диска только при листании истории назад.
+HOT_MESSAGES = 500
+SEGMENT_SIZE = 1000
+SEGMENT_CACHE = 8
+
+class Conversation:
+    __slots__ = ("id", "name", "members", "messages", "cursors", "archived")
+
+    def __init__(self, chat_id, name, members, messages=None, cursors=None, archived=0):
+        self.id = chat_id
+        self.name = name
+        self.members = list(members)
+        self.messages = messages if messages is not None else []  # только горячий хвост
+        # ник -> сколько сообщений участник уже прочитал
+        self.cursors = cursors if cursors is not None else {}
+        self.archived = archived  # сколько первых сообщений лежит в сжатых сегментах
+
+    @property
+    def total(self):
+        return self.archived + len(self.messages)
+
+    @property
+    def is_group(self):
+        return self.id.startswith("group:")
+
+    def title_for(self, nick):
+        if self.is_group:
+            return self.name
+        others = [m for m in self.members if m != nick]
+        return others[0] if others else nick
+
+    @classmethod
+    def from_dict(cls, chat_id, data):
+        return cls(
+            chat_id,
+            data.get("name", ""),
+            data.get("members", []),
+            [Message.from_dict(m) for m in data.get("messages", [])],
+            dict(data.get("cursors", {})),
+            data.get("archived", 0),
+        )
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "members": self.members,
+            "cursors": self.cursors,
+            "archived": self.archived,
+            "messages": [m.to_dict() for m in self.messages],
+        }
+
+class ChatStore:
+    # Каждое сообщение хранится один раз - в своей переписке, а не у каждого участника
+    def __init__(self, path=CHATS_DB, history_dir=HISTORY_DIR, receipts_dir=RECEIPTS_DIR):
+        self.path = path
+        self.history_dir = history_dir
+        self.receipts_dir = receipts_dir
+        self.read_cursors = {}   # ник -> {id переписки: прочитано}, переживает перечитывание chats.json
+        self.receipt_files = {}  # путь файла отметок -> отпечаток уже прочитанной версии
+        self.segments = OrderedDict()  # (id переписки, номер сегмента) -> список Message
+        self.conversations = {}
+        self.by_member = {}  # ник -> множество id переписок
+        self.unread = {}     # id переписки -> {ник: непрочитанных}, меняется по ходу, без обхода истории
+        self.stamp = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            stamp = file_stamp(self.path)
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                conversations = {
+                    chat_id: Conversation.from_dict(chat_id, conv)
+                    for chat_id, conv in data.get("conversations", {}).items()
+                }
+            except FileNotFoundError:
+                conversations = {}
+            except Exception as e:
+                # Старое состояние лучше пустого: иначе следующий save() затёр бы все переписки
+                print(f"Ошибка при чтении {self.path}: {e}")
+                return False
+            self.conversations = conversations
+            self.by_member = {}
+            self.unread = {}
+            for conv in self.conversations.values():
+                self.index(conv)
+            self.stamp = stamp
+            for nick, cursors in list(self.read_cursors.items()):
+                for chat_id, upto in list(cursors.items()):
+                    self.mark_read(chat_id, nick, upto)
+            self.load_receipts()
+            return True
+
+    def reload_if_changed(self):
+        if file_stamp(self.path) == self.stamp:
+            return False
+        return self.load()
+
+    def save(self):
+        with self.lock:
+            for conv in self.conversations.values():
+                self.archive(conv)
+            data = {"conversations": {
+                chat_id: conv.to_dict() for chat_id, conv in self.conversations.items()
+            }}
+            try:
+                write_json_atomic(self.path, data)
+            except Exception as e:
+                print(f"Ошибка при сохранении {self.path}: {e}")
+                return False
+            self.stamp = file_stamp(self.path)
+            return True
+
+    def receipts_path(self, nick):
+        name = hashlib.sha1(nick.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.receipts_dir, f"{name}.json")
+
+    def load_receipts(self, nick=None):
+        # Перечитываются только изменившиеся файлы; курсоры лишь сдвигаются вперёд
+        with self.lock:
+            if nick is not None:
+                paths = [self.receipts_path(nick)]
+            else:
+                try:
+                    paths = [e.path for e in os.scandir(self.receipts_dir) if e.name.endswith(".json")]
+                except OSError:
+                    paths = []
+            for path in paths:
+                stamp = file_stamp(path)
+                if stamp is None or stamp == self.receipt_files.get(path):
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    owner, cursors = data["nick"], dict(data["cursors"])
+                except Exception as e:
+                    print(f"Ошибка при чтении {path}: {e}")
+                    continue
+                self.receipt_files[path] = stamp
+                for chat_id, upto in cursors.items():
+                    if isinstance(upto, int):
+                        self.mark_read(chat_id, owner, upto)
+
+    def save_receipts(self, nick):
+        # Прочтение не переписывает общий chats.json: у каждого пользователя свой файл
+        with self.lock:
+            path = self.receipts_path(nick)
+            data = {"nick": nick, "cursors": dict(self.read_cursors.get(nick, {}))}
+            try:
+                os.makedirs(self.receipts_dir, exist_ok=True)
+                write_json_atomic(path, data)
+            except Exception as e:
+                print(f"Ошибка при сохранении {path}: {e}")
+                return False
+            self.receipt_files[path] = file_stamp(path)
+            return True
+
+    def segment_path(self, chat_id, number):
+        # В id переписок есть символы, недопустимые в именах файлов
+        folder = hashlib.sha1(chat_id.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.history_dir, folder, f"{number:06}.json.z")
+
+    def archive(self, conv):
+        while len(conv.messages) - SEGMENT_SIZE >= HOT_MESSAGES:
+            number = conv.archived // SEGMENT_SIZE
+            segment = conv.messages[:SEGMENT_SIZE]
+            path = self.segment_path(conv.id, number)
+            raw = json.dumps([m.to_dict() for m in segment], ensure_ascii=False, separators=(",", ":"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(zlib.compress(raw.encode("utf-8"), 9))
+            os.replace(path + ".tmp", path)
+            self.cache_segment(conv.id, number, segment)
+            del conv.messages[:SEGMENT_SIZE]
+            conv.archived += SEGMENT_SIZE
+
+    def cache_segment(self, chat_id, number, messages):
+        self.segments[(chat_id, number)] = messages
+        self.segments.move_to_end((chat_id, number))
+        while len(self.segments) > SEGMENT_CACHE:
+            self.segments.popitem(last=False)
+
+    def load_segment(self, chat_id, number):
+        messages = self.segments.get((chat_id, number))
+        if messages is not None:
+            self.segments.move_to_end((chat_id, number))
+            return messages
+        try:
+            with open(self.segment_path(chat_id, number), "rb") as f:
+                raw = zlib.decompress(f.read())
+            messages = [Message.from_dict(m) for m in json.loads(raw.decode("utf-8"))]
+        except Exception as e:
+            print(f"Ошибка при чтении сегмента истории {chat_id}/{number}: {e}")
+            return []
+        self.cache_segment(chat_id, number, messages)
+        return messages
+
+    def page(self, chat_id, start, end):
+        # Сообщения [start, end) по сквозной нумерации; архив подгружается прозрачно
+        with self.lock:
+            conv = self.conversations.get(chat_id)
+            if conv is None:
+                return []
+            start, end = max(start, 0), min(end, conv.total)
+            result = []
+            pos = start
+            while pos < min(end, conv.archived):
+                number = pos // SEGMENT_SIZE
+                first = number * SEGMENT_SIZE
+                segment = self.load_segment(chat_id, number)
+                stop = min(end, conv.archived, first + SEGMENT_SIZE)
+                result.extend(segment[pos - first:stop - first])
+                pos = stop
+            if pos < end:
+                result.extend(conv.messages[pos - conv.archived:end - conv.archived])
+            return result
+
+    def index(self, conv):
+        total = conv.total
+        counters = self.unread.setdefault(conv.id, {})
+        for nick in conv.members:
+            self.by_member.setdefault(nick, set()).add(conv.id)
+            counters[nick] = max(total - conv.cursors.get(nick, 0), 0)
+
+    # Читатели тоже берут замок: потоки API перечитывают файл параллельно с ними
+    def unread_count(self, chat_id, nick):
+        with self.lock:
+            return self.unread.get(chat_id, {}).get(nick, 0)
+
+    def get(self, chat_id):
+        with self.lock:
+            return self.conversations.get(chat_id)
+
+    def chats_for(self, nick):
+        with self.lock:
+            return [self.conversations[c] for c in self.by_member.get(nick, ())]
+
+    def direct_chat(self, nick1, nick2):
+        chat_id = get_chat_key(nick1, nick2)
+        with self.lock:
+            conv = self.conversations.get(chat_id)
+            if conv is None:
+                conv = self.conversations[chat_id] = Conversation(chat_id, "", sorted([nick1, nick2]))
+                self.index(conv)
+            return conv
+
+    def create_group(self, name, members):
+        chat_id = f"group:{uuid.uuid4().hex[:12]}"
+        with self.lock:
+            conv = self.conversations[chat_id] = Conversation(chat_id, name, sorted(set(members)))
+            self.index(conv)
+            return conv
+
+    def append(self, chat_id, msg):
+        with self.lock:
+            conv = self.conversations[chat_id]
+            conv.messages.append(msg)
+            total = conv.total
+            counters = self.unread[chat_id]
+            sender = msg.sender
+            for nick in conv.members:
+                if nick != sender:
+                    counters[nick] = counters.get(nick, 0) + 1
+            # Своё сообщение отправитель уже прочитал
+            if sender in counters:
+                conv.cursors[sender] = total
+                counters[sender] = 0
+            return total
+
+    def mark_read(self, chat_id, nick, upto=None):
+        with self.lock:
+            conv = self.conversations.get(chat_id)
+            if conv is None:
+                return False
+            upto = conv.total if upto is None else min(upto, conv.total)
+            known = self.read_cursors.setdefault(nick, {})
+            known[chat_id] = max(known.get(chat_id, 0), upto)
+            if conv.cursors.get(nick, 0) >= upto:
+                return False
+            conv.cursors[nick] = upto
+            if nick in self.unread[chat_id]:
+                self.unread[chat_id][nick] = conv.total - upto
+            return True
+
+    def migrate_from_users(self, users):
+        # Переносим старые истории из users.json, где каждая лежала у обоих собеседников.
+        # Старые сообщения встают перед уже перенесёнными, повторы отбрасываются;
+        # из users.json история убирается только после успешной записи chats.json
+        moved = merged = False
+        with self.lock:
+            for user in users.values():
+                messages = user.get("messages")
+                if not messages:
+                    continue
+                moved = True
+                for key, history in messages.items():
+                    merged = self.merge_legacy(key, history) or merged
+            if merged and not self.save():
+                return False
+        for user in users.values():
+            user.pop("messages", None)
+        return moved
+
+    def merge_legacy(self, chat_id, history):
+        if not history:
+            return False
+        conv = self.conversations.get(chat_id)
+        if conv is None:
+            conv = self.conversations[chat_id] = Conversation(chat_id, "", chat_id.split("|"))
+        current = self.page(chat_id, 0, conv.total)
+        seen = {(m.sender_id, m.ts, m.body) for m in current}
+        older = []
+        for msg in history:
+            key = (msg.sender_id, msg.ts, msg.body)
+            if key not in seen:
+                seen.add(key)
+                older.append(msg)
+        if not older:
+            return False
+        # Нумерация сдвигается, поэтому архив переписки пересобирается при сохранении
+        for number in [k for k in self.segments if k[0] == chat_id]:
+            del self.segments[number]
+        conv.messages = older + current
+        conv.archived = 0
+        # Старая история считается прочитанной
+        for nick in conv.members:
+            conv.cursors[nick] = conv.cursors.get(nick, 0) + len(older)
+        self.index(conv)
+        return True
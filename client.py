@@ -1,41 +1,110 @@
 import sys
-import json
-import random
 import re
+import bisect
 import os
-import shutil
+import socket
+import threading
+import time
+import zlib
 from datetime import datetime
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QLabel, QLineEdit, QPushButton,
     QVBoxLayout, QHBoxLayout, QMessageBox, QListWidget, QListWidgetItem,
     QTextEdit, QFileDialog, QSizePolicy
 )
-from PyQt5.QtCore import Qt, QTimer, QSize
+from PyQt5.QtCore import Qt, QTimer, QSize, QObject, pyqtSignal
 from PyQt5.QtGui import QColor, QIcon, QPixmap
-from flask import Flask
 
-USERS_DB = "users.json"
+from storage import (
+    Message, load_users, save_users, users_mtime, generate_nick, get_chat_key,
+    now_timestamp, nick_index, is_message_dict
+)
+from protocol import PORT, COMPRESSION, FrameReader, FrameWriter, encode_frame, decode_frame
+from chats import ChatStore
+from friends import FriendGraph
+
+RELAY_HOST = os.environ.get("FPIERSK_SERVER", "127.0.0.1")
+
+AWAY_AFTER = 5 * 60      # секунд без активности до статуса "отошёл"
+TYPING_RESEND = 1.5      # как часто повторять "печатает", пока пользователь набирает
+TYPING_TIMEOUT = 5       # через сколько секунд без обновлений гасить "печатает"
+
+PRESENCE_COLORS = {"online": "#43b581", "away": "#faa61a", "offline": "#747f8d"}
+
+RECEIPTS_FLUSH = 1000    # мс между пачками отметок о прочтении
+HISTORY_PAGE = 200       # сколько сообщений показывать и догружать за раз
 
-def load_users():
-    try:
-        with open(USERS_DB, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+class RelayConnection(QObject):
+    frame_received = pyqtSignal(dict)
 
-def save_users(users):
-    try:
-        with open(USERS_DB, "w", encoding="utf-8") as f:
-            json.dump(users, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        print(f"Ошибка при сохранении users.json: {e}")
+    def __init__(self, hello):
+        super().__init__()
+        self.hello = hello
+        self.sock = None
+        self.writer = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
 
-def generate_nick(name):
-    digits = f"{random.randint(0,9999):04}"
-    return f"{name}#{digits}"
+    def run(self):
+        try:
+            sock = socket.create_connection((RELAY_HOST, PORT), timeout=3)
+        except OSError:
+            return  # без сервера чат работает как раньше, через users.json
+        reader = FrameReader(sock)
+        writer = FrameWriter(sock)
+        try:
+            # До ответа сервера ничего больше не шлём: после него поток может стать сжатым
+            writer.send(encode_frame(dict(self.hello, compress=[COMPRESSION])))
+            welcome = decode_frame(next(reader, b""))
+            sock.settimeout(None)
+            if welcome is not None and welcome.get("type") == "welcome":
+                if welcome.get("compress") == COMPRESSION:
+                    writer.enable_compression()
+                    reader.enable_compression()
+            elif welcome is not None:
+                self.frame_received.emit(welcome)  # старый сервер без согласования
+            self.sock, self.writer = sock, writer
+            for line in reader:
+                frame = decode_frame(line)
+                if frame is not None:
+                    self.frame_received.emit(frame)
+        except (OSError, zlib.error):
+            pass
+        self.sock = self.writer = None
+
+    def send(self, frame):
+        writer = self.writer
+        if writer is None:
+            return
+        try:
+            writer.send(encode_frame(frame))
+        except OSError:
+            pass
 
-def get_chat_key(nick1, nick2):
-    return "|".join(sorted([nick1, nick2]))
+    def close(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+def make_unread_badge():
+    badge = QLabel()
+    badge.setStyleSheet(
+        "background-color: #f04747; color: white; font-weight: 700;"
+        " font-size: 11px; border-radius: 9px; padding: 1px 6px;"
+    )
+    badge.hide()
+    return badge
+
+def update_unread_badge(badge, count):
+    if count:
+        badge.setText(str(count) if count < 100 else "99+")
+        badge.show()
+    else:
+        badge.hide()
 
 class FriendListItem(QWidget):
     def __init__(self, nick):
@@ -55,13 +124,83 @@ class FriendListItem(QWidget):
         avatar.setStyleSheet("border-radius:20px;")
         layout.addWidget(avatar)
 
+        self.status_dot = QLabel()
+        self.status_dot.setFixedSize(12, 12)
+        layout.addWidget(self.status_dot)
+
+        text_layout = QVBoxLayout()
+        text_layout.setSpacing(0)
         nick_label = QLabel(self.nick)
         nick_label.setStyleSheet("color: white; font-weight: 600; font-size: 14px;")
-        layout.addWidget(nick_label)
+        text_layout.addWidget(nick_label)
+        self.status_label = QLabel()
+        self.status_label.setStyleSheet("color: #b9bbbe; font-weight: 400; font-size: 11px;")
+        text_layout.addWidget(self.status_label)
+        layout.addLayout(text_layout)
 
         layout.addStretch()
+        self.badge = make_unread_badge()
+        layout.addWidget(self.badge)
         self.setLayout(layout)
 
+        self.presence = "offline"
+        self.typing = False
+        self.set_presence("offline")
+
+    def set_unread(self, count):
+        update_unread_badge(self.badge, count)
+
+    def set_presence(self, state):
+        self.presence = state
+        self.status_dot.setStyleSheet(f"background-color: {PRESENCE_COLORS[state]}; border-radius: 6px;")
+        self.update_status_text()
+
+    def set_typing(self, typing):
+        self.typing = typing
+        self.update_status_text()
+
+    def update_status_text(self):
+        if self.typing:
+            self.status_label.setText("печатает…")
+        else:
+            self.status_label.setText({"online": "в сети", "away": "отошёл", "offline": "не в сети"}[self.presence])
+
+class GroupListItem(QWidget):
+    def __init__(self, name, members):
+        super().__init__()
+        layout = QHBoxLayout()
+        layout.setContentsMargins(5, 2, 5, 2)
+
+        avatar = QLabel()
+        pixmap = QPixmap(40, 40)
+        pixmap.fill(QColor("#43b581"))
+        avatar.setPixmap(pixmap)
+        avatar.setFixedSize(40, 40)
+        avatar.setStyleSheet("border-radius:20px;")
+        layout.addWidget(avatar)
+
+        text_layout = QVBoxLayout()
+        text_layout.setSpacing(0)
+        self.name_label = QLabel(name)
+        self.name_label.setStyleSheet("color: white; font-weight: 600; font-size: 14px;")
+        text_layout.addWidget(self.name_label)
+        self.members_label = QLabel()
+        self.members_label.setStyleSheet("color: #b9bbbe; font-weight: 400; font-size: 11px;")
+        text_layout.addWidget(self.members_label)
+        layout.addLayout(text_layout)
+
+        layout.addStretch()
+        self.badge = make_unread_badge()
+        layout.addWidget(self.badge)
+        self.setLayout(layout)
+        self.set_members(members)
+
+    def set_members(self, members):
+        self.members_label.setText(f"участников: {len(members)}")
+
+    def set_unread(self, count):
+        update_unread_badge(self.badge, count)
+
 class ChatMessageItem(QLabel):
     def __init__(self, text, is_sender):
         super().__init__()
@@ -101,7 +240,12 @@ class LoginRegisterWindow(QWidget):
         self.setWindowTitle("Регистрация / Вход")
         self.resize(360, 260)
 
-        self.users = load_users()
+        # База пользователей загружается в фоне после первой отрисовки окна
+        self.users = None
+        self.loaded_users = None
+        self.users_mtime = None  # mtime users.json на момент чтения self.users
+        self.loaded_mtime = None
+        self.users_loader = None
 
         self.email_label = QLabel("Почта:")
         self.email_input = QLineEdit()
@@ -174,6 +318,29 @@ class LoginRegisterWindow(QWidget):
             }
         """)
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.users_loader is None:
+            self.users_loader = threading.Thread(target=self.load_users_background, daemon=True)
+            QTimer.singleShot(0, self.users_loader.start)
+
+    def load_users_background(self):
+        # mtime берём до чтения: изменение во время чтения заметит опрос окна чата
+        self.loaded_mtime = users_mtime()
+        self.loaded_users = load_users()
+
+    def ensure_users(self):
+        # Дожидаемся фоновой загрузки (или грузим сами, если она ещё не стартовала)
+        if self.users is not None:
+            return self.users
+        if self.users_loader is not None and self.users_loader.is_alive():
+            self.users_loader.join()
+        self.users, self.users_mtime = self.loaded_users, self.loaded_mtime
+        if self.users is None:
+            self.users_mtime = users_mtime()
+            self.users = load_users()
+        return self.users
+
     def register(self):
         email = self.email_input.text().strip()
         password = self.pass_input.text()
@@ -187,13 +354,14 @@ class LoginRegisterWindow(QWidget):
             QMessageBox.warning(self, "Ошибка", "Неверный формат почты")
             return
 
-        if email in self.users:
+        if email in self.ensure_users():
             QMessageBox.warning(self, "Ошибка", "Пользователь с такой почтой уже существует")
             return
 
         nick = generate_nick(name)
-        self.users[email] = {"password": password, "nick": nick, "friends": [], "messages": {}}
+        self.users[email] = {"password": password, "nick": nick}
         save_users(self.users)
+        self.users_mtime = users_mtime()
 
         QMessageBox.information(self, "Успех", f"Зарегистрировано! Ваш ник: {nick}")
         self.nick_input.clear()
@@ -202,17 +370,19 @@ class LoginRegisterWindow(QWidget):
         email = self.email_input.text().strip()
         password = self.pass_input.text()
 
-        user = self.users.get(email)
+        user = self.ensure_users().get(email)
         if not user or user["password"] != password:
             QMessageBox.warning(self, "Ошибка", "Неверная почта или пароль")
             return
 
-        self.chat_window = ChatWindow(user, self.users, email)
+        self.chat_window = ChatWindow(user, self.users, email, self.users_mtime)
         self.chat_window.show()
         self.close()
 
 class ChatWindow(QWidget):
-    def __init__(self, user, users_db, user_email):
+    chats_loaded = pyqtSignal()
+
+    def __init__(self, user, users_db, user_email, users_db_mtime):
         super().__init__()
         self.setWindowTitle(f"Fpiersk - {user['nick']}")
         self.resize(900, 650)
@@ -288,11 +458,23 @@ class ChatWindow(QWidget):
             }
         """)
 
+        self.group_name_input = QLineEdit()
+        self.group_name_input.setPlaceholderText("Название группы")
+        self.group_name_input.setStyleSheet(self.add_friend_input.styleSheet())
+        self.group_members_input = QLineEdit()
+        self.group_members_input.setPlaceholderText("Ники участников через запятую")
+        self.group_members_input.setStyleSheet(self.add_friend_input.styleSheet())
+        self.create_group_btn = QPushButton("Создать группу")
+        self.create_group_btn.setStyleSheet(self.add_friend_btn.styleSheet())
+
         left_layout = QVBoxLayout()
-        left_layout.addWidget(QLabel("Друзья:"))
+        left_layout.addWidget(QLabel("Друзья и группы:"))
         left_layout.addWidget(self.friends_list)
         left_layout.addWidget(self.add_friend_input)
         left_layout.addWidget(self.add_friend_btn)
+        left_layout.addWidget(self.group_name_input)
+        left_layout.addWidget(self.group_members_input)
+        left_layout.addWidget(self.create_group_btn)
 
         self.chat_header = QLabel("Выберите друга для начала общения")
         self.chat_header.setObjectName("chat_header")
@@ -362,8 +544,13 @@ class ChatWindow(QWidget):
         input_layout.addWidget(self.message_input)
         input_layout.addWidget(self.attach_btn)
 
+        self.load_more_btn = QPushButton("Показать более ранние сообщения")
+        self.load_more_btn.setStyleSheet(self.add_friend_btn.styleSheet())
+        self.load_more_btn.hide()
+
         right_layout = QVBoxLayout()
         right_layout.addWidget(self.chat_header)
+        right_layout.addWidget(self.load_more_btn)
         right_layout.addWidget(self.chat_display)
         right_layout.addLayout(input_layout)
 
@@ -374,65 +561,335 @@ class ChatWindow(QWidget):
         self.setLayout(main_layout)
 
         self.add_friend_btn.clicked.connect(self.add_friend)
+        self.create_group_btn.clicked.connect(self.create_group)
         self.friends_list.itemSelectionChanged.connect(self.friend_selected)
         self.message_input.returnPressed.connect(self.send_message)
         self.attach_btn.clicked.connect(self.attach_image)
+        self.load_more_btn.clicked.connect(self.load_more_history)
 
         self.current_friend = None
-
+        self.current_chat = None
+        self.history_limit = HISTORY_PAGE
+        self.friend_rows = {}    # ник -> (QListWidgetItem, FriendListItem)
+        self.friend_nicks = []   # ники друзей по порядку строк в списке
+        self.group_rows = {}     # id группы -> (QListWidgetItem, GroupListItem)
+        self.presence = {}       # ник -> online/away
+        self.typing_until = {}   # ник -> время, до которого показываем "печатает"
+        self.my_presence = "online"
+        self.last_activity = time.monotonic()
+        self.last_typing_sent = 0
+
+        # Опрос базы запускается только после показа окна; сравниваем с mtime снимка users_db,
+        # а не с текущим, иначе правки между входом и открытием окна не будут замечены
+        self.users_mtime = users_db_mtime
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.auto_update_chat)
-        self.timer.start(1000)
 
-        self.update_friends_list()
+        self.presence_timer = QTimer(self)
+        self.presence_timer.timeout.connect(self.check_presence)
+
+        # История переписок грузится в фоне уже после показа окна
+        self.chats = ChatStore()
+        self.chats_loader = None
+        self.chats_ready = False
+        self.chats_loaded.connect(self.on_chats_loaded)
+
+        # Отметки о прочтении копятся и уходят одной пачкой
+        self.pending_receipts = {}  # id переписки -> сколько сообщений прочитано
+        self.receipts_timer = QTimer(self)
+        self.receipts_timer.timeout.connect(self.flush_receipts)
+
+        self.relay = RelayConnection(self.hello_frame())
+        self.relay.frame_received.connect(self.handle_frame)
+        self.message_input.textEdited.connect(self.on_text_edited)
+
+        self.nick_to_email = nick_index(self.users_db)
+        self.friend_graph = FriendGraph()
+        self.friend_graph.load()
+        if self.friend_graph.migrate_from_users(self.users_db):
+            self.friend_graph.save()
+            save_users(self.users_db)
+            self.users_mtime = users_mtime()
+        self.friend_graph.subscribe(self.user_email, self.on_friends_changed)
+        self.on_friends_changed(self.friend_graph.friends(self.user_email), set())
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not self.timer.isActive():
+            self.timer.start(1000)
+            self.presence_timer.start(1000)
+            self.receipts_timer.start(RECEIPTS_FLUSH)
+            self.relay.start()
+            self.chats_loader = threading.Thread(target=self.load_chats_background, daemon=True)
+            self.chats_loader.start()
+
+    def load_chats_background(self):
+        self.chats.load()
+        self.chats_loaded.emit()
+
+    def ensure_chats(self):
+        if not self.chats_ready:
+            if self.chats_loader is not None:
+                self.chats_loader.join()
+            else:
+                self.chats.load()
+            self.on_chats_loaded()
+        return self.chats
+
+    def on_chats_loaded(self):
+        if self.chats_ready:
+            return
+        self.chats_ready = True
+        if self.chats.migrate_from_users(self.users_db):
+            save_users(self.users_db)
+            self.users_mtime = users_mtime()
+        self.update_groups_list()
+        self.refresh_all_unread()
+        self.relay.hello = self.hello_frame()
+        self.relay.send(self.relay.hello)
+        if self.current_chat:
+            self.load_chat_history()
+            self.read_current_chat()
+
+    def closeEvent(self, event):
+        self.friend_graph.unsubscribe(self.user_email, self.on_friends_changed)
+        self.flush_receipts()
+        self.relay.send({"type": "presence", "state": "offline"})
+        self.relay.close()
+        super().closeEvent(event)
+
+    def hello_frame(self):
+        return {
+            "type": "hello",
+            "nick": self.user["nick"],
+            "friends": list(self.friend_nicks),
+            "state": self.my_presence,
+            "chats": [c.id for c in self.chats.chats_for(self.user["nick"])] if self.chats_ready else [],
+        }
+
+    def on_friends_changed(self, added, removed):
+        # Граф присылает только изменившиеся id - меняем только эти строки
+        for user_id in removed:
+            nick = self.users_db.get(user_id, {}).get("nick")
+            if nick not in self.friend_rows:
+                continue
+            index = bisect.bisect_left(self.friend_nicks, nick)
+            del self.friend_nicks[index]
+            self.friend_rows.pop(nick)
+            self.friends_list.takeItem(index)
+        for user_id in added:
+            nick = self.users_db.get(user_id, {}).get("nick")
+            if nick is None or nick in self.friend_rows:
+                continue
+            index = bisect.bisect_left(self.friend_nicks, nick)
+            self.friend_nicks.insert(index, nick)
+            item = QListWidgetItem()
+            item.setData(Qt.UserRole, nick)
+            widget = FriendListItem(nick)
+            widget.set_presence(self.presence.get(nick, "offline"))
+            if self.chats_ready:
+                widget.set_unread(self.chats.unread_count(get_chat_key(self.user["nick"], nick), self.user["nick"]))
+            item.setSizeHint(widget.sizeHint())
+            self.friends_list.insertItem(index, item)
+            self.friends_list.setItemWidget(item, widget)
+            self.friend_rows[nick] = (item, widget)
+        # Сервер должен знать актуальный список друзей для рассылки статусов
+        self.relay.hello = self.hello_frame()
+        self.relay.send(self.relay.hello)
+
+    def update_groups_list(self):
+        groups = sorted(
+            (c for c in self.chats.chats_for(self.user["nick"]) if c.is_group),
+            key=lambda c: (c.name.lower(), c.id),
+        )
+        wanted = {c.id for c in groups}
+        new_ids = []
+        for chat_id in list(self.group_rows):
+            if chat_id not in wanted:
+                item, _ = self.group_rows.pop(chat_id)
+                self.friends_list.takeItem(self.friends_list.row(item))
+        # Группы идут в списке после друзей
+        offset = len(self.friend_rows)
+        for index, conv in enumerate(groups):
+            row = self.group_rows.get(conv.id)
+            if row is not None:
+                row[1].set_members(conv.members)
+                continue
+            item = QListWidgetItem()
+            item.setData(Qt.UserRole, conv.id)
+            widget = GroupListItem(conv.name, conv.members)
+            widget.set_unread(self.chats.unread_count(conv.id, self.user["nick"]))
+            item.setSizeHint(widget.sizeHint())
+            self.friends_list.insertItem(offset + index, item)
+            self.friends_list.setItemWidget(item, widget)
+            self.group_rows[conv.id] = (item, widget)
+            new_ids.append(conv.id)
+        if new_ids:
+            self.relay.hello = self.hello_frame()
+            self.relay.send({"type": "subscribe", "chats": new_ids})
+
+    def handle_frame(self, frame):
+        # Кадры приходят от других клиентов как есть: исключение в слоте уронит PyQt
+        kind = frame.get("type")
+        if kind == "presence":
+            if isinstance(frame.get("nick"), str) and isinstance(frame.get("state"), str):
+                self.set_friend_presence(frame["nick"], frame["state"])
+        elif kind == "presence_batch":
+            states = frame.get("states")
+            if isinstance(states, dict):
+                for nick, state in states.items():
+                    if isinstance(state, str):
+                        self.set_friend_presence(nick, state)
+        elif kind == "typing":
+            nick = frame.get("from")
+            if not isinstance(nick, str):
+                return
+            if frame.get("typing"):
+                self.typing_until[nick] = time.monotonic() + TYPING_TIMEOUT
+            else:
+                self.typing_until.pop(nick, None)
+            self.set_friend_typing(nick, bool(frame.get("typing")))
+        elif kind == "message" and self.chats_ready:
+            chat_id, index = frame.get("chat"), frame.get("index")
+            if not isinstance(chat_id, str) or not isinstance(index, int) or not is_message_dict(frame.get("message")):
+                return
+            conv = self.chats.get(chat_id)
+            if conv is None:
+                return
+            if conv.total == index - 1:
+                # Показываем сразу; на диск сообщение уже записал отправитель
+                self.chats.append(conv.id, Message.from_dict(frame["message"]))
+            elif conv.total < index:
+                # Что-то пропустили - берём переписку с диска
+                self.chats.reload_if_changed()
+            else:
+                return  # уже прочитано с диска вместе с приглашением или опросом
+            if chat_id == self.current_chat:
+                self.load_chat_history()
+                self.read_current_chat()
+            self.refresh_unread(chat_id)
+        elif kind == "invite" and self.chats_ready:
+            self.chats.load()
+            self.update_groups_list()
+            self.refresh_all_unread()
+        elif kind == "receipts" and self.chats_ready:
+            nick, cursors = frame.get("from"), frame.get("cursors")
+            if not isinstance(nick, str) or not isinstance(cursors, dict):
+                return
+            for chat_id, upto in cursors.items():
+                if not isinstance(upto, int):
+                    continue
+                if self.chats.mark_read(chat_id, nick, upto) and chat_id == self.current_chat:
+                    self.load_chat_history()
+
+    def row_widget_for_chat(self, chat_id):
+        row = self.group_rows.get(chat_id)
+        if row is None:
+            conv = self.chats.get(chat_id)
+            if conv is None or conv.is_group:
+                return None
+            row = self.friend_rows.get(conv.title_for(self.user["nick"]))
+        return row[1] if row is not None else None
+
+    def refresh_unread(self, chat_id):
+        widget = self.row_widget_for_chat(chat_id)
+        if widget is not None:
+            widget.set_unread(self.chats.unread_count(chat_id, self.user["nick"]))
+
+    def refresh_all_unread(self):
+        for conv in self.chats.chats_for(self.user["nick"]):
+            self.refresh_unread(conv.id)
+
+    def read_current_chat(self):
+        if not self.chats_ready or not self.current_chat or not self.isVisible():
+            return
+        if self.chats.mark_read(self.current_chat, self.user["nick"]):
+            conv = self.chats.get(self.current_chat)
+            self.pending_receipts[self.current_chat] = conv.cursors[self.user["nick"]]
+            self.refresh_unread(self.current_chat)
+
+    def flush_receipts(self):
+        if not self.pending_receipts:
+            return
+        receipts, self.pending_receipts = self.pending_receipts, {}
+        # Курсоры уже сдвинуты в памяти; на диск - одна запись в свой файл на пачку
+        self.chats.save_receipts(self.user["nick"])
+        self.relay.send({"type": "receipts", "cursors": receipts})
+        for chat_id in receipts:
+            self.refresh_unread(chat_id)
+
+    def set_friend_presence(self, nick, state):
+        if state not in PRESENCE_COLORS:
+            return
+        if state == "offline":
+            self.presence.pop(nick, None)
+        else:
+            self.presence[nick] = state
+        row = self.friend_rows.get(nick)
+        if row is not None and row[1].presence != state:
+            row[1].set_presence(state)
+
+    def set_friend_typing(self, nick, typing):
+        row = self.friend_rows.get(nick)
+        if row is not None and row[1].typing != typing:
+            row[1].set_typing(typing)
+        if nick == self.current_friend:
+            suffix = " — печатает…" if typing else ""
+            self.chat_header.setText(f"Чат с {self.current_friend}{suffix}")
+
+    def check_presence(self):
+        now = time.monotonic()
+        for nick, until in list(self.typing_until.items()):
+            if until <= now:
+                del self.typing_until[nick]
+                self.set_friend_typing(nick, False)
+        if self.my_presence == "online" and now - self.last_activity > AWAY_AFTER:
+            self.set_my_presence("away")
+
+    def set_my_presence(self, state):
+        if state != self.my_presence:
+            self.my_presence = state
+            self.relay.hello["state"] = state
+            self.relay.send({"type": "presence", "state": state})
+
+    def touch_activity(self):
+        self.last_activity = time.monotonic()
+        self.set_my_presence("online")
+
+    def on_text_edited(self, text):
+        self.touch_activity()
+        if not self.current_friend or not text:
+            return
+        now = time.monotonic()
+        if now - self.last_typing_sent >= TYPING_RESEND:
+            self.last_typing_sent = now
+            self.relay.send({"type": "typing", "to": self.current_friend, "typing": True})
 
-    def update_friends_list(self):
-        self.friends_list.clear()
-        friends = self.user.get("friends", [])
-        for nick in sorted(friends):
-            item = QListWidgetItem(nick)
-            font = item.font()
-            font.setPointSize(18)  # Сделать ник крупнее
-            font.setBold(True)
-            item.setFont(font)
-            self.friends_list.addItem(item)
+    def stop_typing(self):
+        if self.current_friend and self.last_typing_sent:
+            self.relay.send({"type": "typing", "to": self.current_friend, "typing": False})
+        self.last_typing_sent = 0
 
     def add_friend(self):
         try:
             nick = self.add_friend_input.text().strip()
             if not nick:
                 return
-            if not any(u.get("nick") == nick for u in self.users_db.values()):
+            friend_email = self.nick_to_email.get(nick)
+            if friend_email is None:
                 QMessageBox.warning(self, "Ошибка", "Пользователь с таким ником не найден")
                 return
-            if nick == self.user["nick"]:
+            if friend_email == self.user_email:
                 QMessageBox.warning(self, "Ошибка", "Нельзя добавить себя")
                 return
-            if nick in self.user.get("friends", []):
+            self.friend_graph.reload_if_changed()
+            if self.friend_graph.are_friends(self.user_email, friend_email):
                 QMessageBox.information(self, "Инфо", "Пользователь уже в друзьях")
                 return
 
-            self.user.setdefault("friends", []).append(nick)
-
-            friend_email = None
-            for email, u in self.users_db.items():
-                if u.get("nick") == nick:
-                    friend_email = email
-                    break
-
-            if friend_email is None:
-                QMessageBox.warning(self, "Ошибка", "Не удалось найти email друга")
-                return
-
-            friend_data = self.users_db[friend_email]
-            friend_data.setdefault("friends", [])
-            if self.user["nick"] not in friend_data["friends"]:
-                friend_data["friends"].append(self.user["nick"])
-            self.users_db[friend_email] = friend_data
-
-            self.users_db[self.user_email] = self.user
-            save_users(self.users_db)
-            self.update_friends_list()
+            # Дружба добавляется сразу в обе стороны; строку в списке добавит событие графа
+            self.friend_graph.add(self.user_email, friend_email)
+            self.friend_graph.save()
             self.add_friend_input.clear()
             QMessageBox.information(self, "Успех", f"Пользователь {nick} добавлен в друзья (взаимно)")
 
@@ -441,17 +898,50 @@ class ChatWindow(QWidget):
             import traceback
             traceback.print_exc()
 
+    def create_group(self):
+        name = self.group_name_input.text().strip()
+        nicks = [n.strip() for n in self.group_members_input.text().split(",") if n.strip()]
+        if not name or not nicks:
+            QMessageBox.warning(self, "Ошибка", "Укажите название группы и ники участников")
+            return
+        missing = [n for n in nicks if n not in self.nick_to_email]
+        if missing:
+            QMessageBox.warning(self, "Ошибка", f"Пользователи не найдены: {', '.join(missing)}")
+            return
+
+        chats = self.ensure_chats()
+        chats.reload_if_changed()
+        conv = chats.create_group(name, nicks + [self.user["nick"]])
+        chats.save()
+        self.relay.send({"type": "invite", "chat": conv.id, "members": conv.members})
+        self.update_groups_list()
+        self.group_name_input.clear()
+        self.group_members_input.clear()
+
     def friend_selected(self):
+        self.touch_activity()
+        self.stop_typing()
         selected = self.friends_list.selectedItems()
+        self.history_limit = HISTORY_PAGE
         if selected:
-            nick = selected[0].text()
-            self.current_friend = nick
-            self.chat_header.setText(f"Чат с {self.current_friend}")
+            chat_id = selected[0].data(Qt.UserRole)
+            if chat_id in self.group_rows:
+                conv = self.chats.get(chat_id)
+                self.current_friend = None
+                self.current_chat = chat_id
+                self.chat_header.setText(f"Группа {conv.name}")
+            else:
+                self.current_friend = chat_id
+                self.current_chat = get_chat_key(self.user["nick"], chat_id)
+                self.chat_header.setText(f"Чат с {self.current_friend}")
             self.load_chat_history()
+            self.read_current_chat()
         else:
             self.current_friend = None
+            self.current_chat = None
             self.chat_header.setText("Выберите друга для начала общения")
             self.chat_display.clear()
+            self.load_more_btn.hide()
 
     def load_chat_history(self):
         scrollbar = self.chat_display.verticalScrollBar()
@@ -459,22 +949,26 @@ class ChatWindow(QWidget):
         scroll_pos = scrollbar.value()
 
         self.chat_display.clear()
-        key = get_chat_key(self.user["nick"], self.current_friend)
-        messages = self.user.get("messages")
-        if messages is None:
-            self.user["messages"] = {}
-            messages = self.user["messages"]
-        chat_history = messages.get(key, [])
+        if not self.chats_ready:
+            return
+        conv = self.chats.get(self.current_chat)
+        start = 0
+        chat_history = []
+        if conv is not None:
+            # Старые сообщения читаются из сжатого архива только при листании назад
+            start = max(conv.total - self.history_limit, 0)
+            chat_history = self.chats.page(conv.id, start, conv.total)
+        self.load_more_btn.setVisible(start > 0)
         for msg in chat_history:
-            time = msg.get("timestamp", "")
-            sender = msg.get("sender", "")
-            msg_type = msg.get("type", "text")
+            time = msg.timestamp
+            sender = msg.sender
+            msg_type = msg.type
             align = "right" if sender == self.user["nick"] else "left"
             color = "#7289da" if sender == self.user["nick"] else "#43b581"
             bubble = "#23272a"
 
             if msg_type == "text":
-                text = msg.get("text", "")
+                text = msg.text
                 html = f"""
                 <div style="text-align:{align}; margin-bottom: 18px;">
                     <span style="font-weight:bold; color:{color}; font-size:14px;">{sender}</span>
@@ -485,7 +979,7 @@ class ChatWindow(QWidget):
                 self.chat_display.append(html)
 
             elif msg_type == "image":
-                file_path = msg.get("file", "")
+                file_path = msg.file
                 if os.path.exists(file_path):
                     html = f"""
                     <div style="text-align:{align}; margin-bottom: 18px;">
@@ -505,48 +999,59 @@ class ChatWindow(QWidget):
                     """
                     self.chat_display.append(html)
 
+        read_status = self.read_status(conv) if conv is not None else ""
+        if read_status:
+            self.chat_display.append(
+                f"<div style='text-align:right; color:#b9bbbe; font-size:11px;'>{read_status}</div>"
+            )
+
         # Восстанавливаем позицию скролла
         scrollbar.setValue(scroll_pos)
 
+    def load_more_history(self):
+        self.history_limit += HISTORY_PAGE
+        self.load_chat_history()
+
+    def read_status(self, conv):
+        # Статус показываем под последним своим сообщением, если оно последнее в чате
+        nick = self.user["nick"]
+        if not conv.messages or conv.messages[-1].sender != nick:
+            return ""
+        total = conv.total
+        others = [m for m in conv.members if m != nick]
+        readers = [m for m in others if conv.cursors.get(m, 0) >= total]
+        if not conv.is_group:
+            return "✓✓ Прочитано" if readers else "✓ Доставлено"
+        return f"Прочитали: {len(readers)} из {len(others)}"
+
+    def post_message(self, msg):
+        # Одна запись в переписку и один кадр ретранслятору - сколько бы ни было участников
+        chats = self.ensure_chats()
+        chats.reload_if_changed()
+        created = chats.get(self.current_chat) is None
+        if created:
+            conv = chats.direct_chat(self.user["nick"], self.current_friend)
+        index = chats.append(self.current_chat, msg)
+        chats.save()
+        if created:
+            self.relay.send({"type": "invite", "chat": conv.id, "members": conv.members})
+        # Порядковый номер нужен получателю, чтобы не добавить сообщение второй раз
+        self.relay.send({"type": "message", "chat": self.current_chat, "index": index, "message": msg.to_dict()})
+
     def send_message(self):
-        if not self.current_friend:
+        if not self.current_chat:
             QMessageBox.warning(self, "Ошибка", "Выберите друга для отправки сообщения")
             return
         message = self.message_input.text().strip()
         if not message:
             return
+        self.touch_activity()
+        self.stop_typing()
 
         try:
-            key = get_chat_key(self.user["nick"], self.current_friend)
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            self.user.setdefault("messages", {})
-            self.user["messages"].setdefault(key, []).append({
-                "sender": self.user["nick"],
-                "type": "text",
-                "text": message,
-                "timestamp": timestamp
-            })
-
-            friend_email = None
-            for email, u in self.users_db.items():
-                if u.get("nick") == self.current_friend:
-                    friend_email = email
-                    break
-
-            if friend_email:
-                friend_data = self.users_db[friend_email]
-                friend_data.setdefault("messages", {})
-                friend_data["messages"].setdefault(key, []).append({
-                    "sender": self.user["nick"],
-                    "type": "text",
-                    "text": message,
-                    "timestamp": timestamp
-                })
-                self.users_db[friend_email] = friend_data
-
-            self.users_db[self.user_email] = self.user
-            save_users(self.users_db)
+            msg = Message(self.user["nick"], "text", message, now_timestamp())
+            timestamp = msg.timestamp
+            self.post_message(msg)
 
             formatted_text = f"{message} <br><span style='font-size:10px; color:#b9bbbe;'>{timestamp}</span>"
             self.chat_display.append(f"<div style='text-align:right; background-color:#5865F2; color:white; padding:8px 12px; border-radius:15px 15px 0 15px; max-width:60%; margin-left:auto; font-size:14px;'>{formatted_text}</div>")
@@ -559,7 +1064,7 @@ class ChatWindow(QWidget):
             traceback.print_exc()
 
     def attach_image(self):
-        if not self.current_friend:
+        if not self.current_chat:
             QMessageBox.warning(self, "Ошибка", "Выберите друга для отправки изображения")
             return
         options = QFileDialog.Options()
@@ -595,36 +1100,8 @@ class ChatWindow(QWidget):
                 scaled_pixmap.save(dest_path)
 
                 # --- СОХРАНЕНИЕ В ИСТОРИЮ ---
-                key = get_chat_key(self.user["nick"], self.current_friend)
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                self.user.setdefault("messages", {})
-                self.user["messages"].setdefault(key, []).append({
-                    "sender": self.user["nick"],
-                    "type": "image",
-                    "file": dest_path,
-                    "timestamp": timestamp
-                })
-
-                friend_email = None
-                for email, u in self.users_db.items():
-                    if u.get("nick") == self.current_friend:
-                        friend_email = email
-                        break
-
-                if friend_email:
-                    friend_data = self.users_db[friend_email]
-                    friend_data.setdefault("messages", {})
-                    friend_data["messages"].setdefault(key, []).append({
-                        "sender": self.user["nick"],
-                        "type": "image",
-                        "file": dest_path,
-                        "timestamp": timestamp
-                    })
-                    self.users_db[friend_email] = friend_data
-
-                self.users_db[self.user_email] = self.user
-                save_users(self.users_db)
+                msg = Message(self.user["nick"], "image", dest_path, now_timestamp())
+                self.post_message(msg)
 
                 self.load_chat_history()
 
@@ -634,18 +1111,25 @@ class ChatWindow(QWidget):
                 traceback.print_exc()
 
     def auto_update_chat(self):
-        updated_users = load_users()
-        updated_user = updated_users.get(self.user_email)
-        if not updated_user:
-            return
-        self.user = updated_user
-        self.users_db = updated_users
-        if self.current_friend:
-            self.load_chat_history()
+        # Перечитываем файлы только если они изменились с прошлого раза
+        mtime = users_mtime()
+        if mtime != self.users_mtime:
+            self.users_mtime = mtime
+            updated_users = load_users()
+            updated_user = updated_users.get(self.user_email)
+            if updated_user:
+                self.user = updated_user
+                self.users_db = updated_users
+                self.nick_to_email = nick_index(updated_users)
+        self.friend_graph.reload_if_changed()
+        if self.chats_ready and self.chats.reload_if_changed():
+            self.update_groups_list()
+            self.refresh_all_unread()
+            if self.current_chat:
+                self.load_chat_history()
+                self.read_current_chat()
 
 if __name__ == "__main__":
-    port = 8080
-    app.run(debug=True,host='0.0.0.0',port=port)
     app = QApplication(sys.argv)
     app.setStyleSheet("""
         QWidget {
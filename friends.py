@@ -0,0 +1,137 @@
+import json
+import threading
+
+from storage import nick_index, file_stamp, write_json_atomic
+
+FRIENDS_DB = "friends.json"
+
+class FriendGraph:
+    # Дружба взаимная: ребро хранится в обоих множествах смежности.
+    # Вершины - id пользователей (ключи users.json), а не ники.
+    def __init__(self, path=FRIENDS_DB):
+        self.path = path
+        self.adjacency = {}  # id -> множество id друзей
+        self.listeners = {}  # id -> список обработчиков f(added, removed)
+        self.stamp = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        changes = {}
+        with self.lock:
+            stamp = file_stamp(self.path)
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    edges = [(a, b) for a, b in json.load(f).get("edges", [])]
+            except FileNotFoundError:
+                edges = []
+            except Exception as e:
+                # Битый файл - не повод сообщать подписчикам, что все друзья удалены
+                print(f"Ошибка при чтении {self.path}: {e}")
+                return False
+            old = self.adjacency
+            self.adjacency = {}
+            for a, b in edges:
+                self.link(a, b)
+            self.stamp = stamp
+            # Подписчикам - только разница со старым состоянием
+            for user_id in self.listeners:
+                before = old.get(user_id, set())
+                after = self.adjacency.get(user_id, set())
+                changes[user_id] = (after - before, before - after)
+        self.notify(changes)
+        return True
+
+    def reload_if_changed(self):
+        if file_stamp(self.path) == self.stamp:
+            return False
+        return self.load()
+
+    def save(self):
+        with self.lock:
+            # Каждое ребро на диске один раз
+            edges = sorted(
+                [a, b] for a, friends in self.adjacency.items() for b in friends if a < b
+            )
+            try:
+                write_json_atomic(self.path, {"edges": edges})
+            except Exception as e:
+                print(f"Ошибка при сохранении {self.path}: {e}")
+                return False
+            self.stamp = file_stamp(self.path)
+            return True
+
+    def subscribe(self, user_id, callback):
+        self.listeners.setdefault(user_id, []).append(callback)
+
+    def unsubscribe(self, user_id, callback):
+        callbacks = self.listeners.get(user_id, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.listeners.pop(user_id, None)
+
+    def notify(self, changes):
+        for user_id, (added, removed) in changes.items():
+            if not added and not removed:
+                continue
+            for callback in list(self.listeners.get(user_id, ())):
+                callback(added, removed)
+
+    def link(self, a, b):
+        if a == b or b in self.adjacency.get(a, ()):
+            return False
+        self.adjacency.setdefault(a, set()).add(b)
+        self.adjacency.setdefault(b, set()).add(a)
+        return True
+
+    def unlink(self, a, b):
+        if b not in self.adjacency.get(a, ()):
+            return False
+        self.adjacency[a].discard(b)
+        self.adjacency[b].discard(a)
+        return True
+
+    def friends(self, user_id):
+        return frozenset(self.adjacency.get(user_id, ()))
+
+    def are_friends(self, a, b):
+        return b in self.adjacency.get(a, ())
+
+    def add(self, a, b):
+        with self.lock:
+            changed = self.link(a, b)
+        if changed:
+            self.notify({a: ({b}, set()), b: ({a}, set())})
+        return changed
+
+    def remove(self, a, b):
+        with self.lock:
+            changed = self.unlink(a, b)
+        if changed:
+            self.notify({a: (set(), {b}), b: (set(), {a})})
+        return changed
+
+    def add_many(self, pairs):
+        # Массовый импорт: по одному событию на пользователя, а не на ребро
+        changes = {}
+        with self.lock:
+            for a, b in pairs:
+                if self.link(a, b):
+                    changes.setdefault(a, (set(), set()))[0].add(b)
+                    changes.setdefault(b, (set(), set()))[0].add(a)
+        self.notify(changes)
+        return sum(len(added) for added, _ in changes.values()) // 2
+
+    def migrate_from_users(self, users):
+        # Раньше друзья лежали списками ников внутри каждого пользователя
+        by_nick = nick_index(users)
+        pairs = []
+        moved = False
+        for email, user in users.items():
+            nicks = user.pop("friends", None)
+            if nicks is None:
+                continue
+            moved = True
+            pairs.extend((email, by_nick[n]) for n in nicks if n in by_nick)
+        self.add_many(pairs)
+        return moved
@@ -0,0 +1,82 @@
+import json
+import threading
+import zlib
+
+PORT = 65432
+
+PRESENCE_STATES = ("online", "away", "offline")
+
+# Единственный поддерживаемый способ сжатия: поток deflate на всё соединение,
+# словарь общий для всех кадров, поэтому повторяющиеся ключи JSON почти бесплатны
+COMPRESSION = "zlib"
+
+# Кадр длиннее этого считается атакой: маленький поток deflate разжимается в гигабайты
+MAX_FRAME = 1024 * 1024
+READ_SIZE = 65536
+
+# Кадр протокола ретранслятора - одна строка JSON, завершённая "\n"
+def encode_frame(frame):
+    return (json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8")
+
+def decode_frame(line):
+    try:
+        frame = json.loads(line.decode("utf-8"))
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) else None
+
+class FrameWriter:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.compressor = None
+
+    def enable_compression(self):
+        with self.lock:
+            self.compressor = zlib.compressobj()
+
+    def send_then_compress(self, data):
+        # Последний несжатый кадр и включение сжатия без зазора: никто не вклинится между ними
+        with self.lock:
+            self.sock.sendall(data)
+            self.compressor = zlib.compressobj()
+
+    def send(self, data):
+        # Сжатие и отправка под одним замком: состояние компрессора последовательное
+        with self.lock:
+            if self.compressor is not None:
+                data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.sock.sendall(data)
+
+class FrameReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+        self.decompressor = None
+
+    def enable_compression(self):
+        # Всё, что пришло после согласования, уже сжато
+        self.decompressor = zlib.decompressobj()
+        self.buffer = self.decompressor.decompress(self.buffer, READ_SIZE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                line, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+                return line
+            if len(self.buffer) > MAX_FRAME:
+                raise ConnectionError("слишком длинный кадр")
+            # Разжимаем порциями: сначала недоразжатый остаток, потом новые данные из сокета
+            if self.decompressor is not None and self.decompressor.unconsumed_tail:
+                chunk = self.decompressor.decompress(self.decompressor.unconsumed_tail, READ_SIZE)
+            else:
+                chunk = self.sock.recv(READ_SIZE)
+                if not chunk:
+                    raise StopIteration
+                if self.decompressor is not None:
+                    chunk = self.decompressor.decompress(chunk, READ_SIZE)
+            self.buffer += chunk
@@ -1,40 +1,247 @@
 import socket
 import threading
+import time
+
+from protocol import (
+    PORT, PRESENCE_STATES, COMPRESSION, FrameReader, FrameWriter, encode_frame, decode_frame
+)
 
 HOST = '0.0.0.0'  # слушаем все интерфейсы
-PORT = 65432
 
-clients = []
+# Минимальный интервал между кадрами одного вида от одного отправителя.
+# Всё, что пришло чаще, схлопывается до последнего состояния.
+MIN_INTERVAL = {"presence": 1.0, "typing": 2.0}
+FLUSH_INTERVAL = 0.2
+PRUNE_INTERVAL = 10.0  # как часто выбрасывать устаревшие записи last_sent
+
+clients = []      # только соединения, уже прошедшие согласование
+writers = {}      # conn -> FrameWriter, чтобы кадры из разных потоков не перемешивались
+conn_nicks = {}   # conn -> ник
+nick_conns = {}   # ник -> conn
+friends = {}      # ник -> множество ников друзей
+presence = {}     # ник -> online/away
+subscribers = {}  # id переписки -> множество conn её участников
+conn_chats = {}   # conn -> множество id переписок, на которые он подписан
+state_lock = threading.Lock()
+
+pending = {}      # (ник, вид, адресат) -> последний кадр, ожидающий отправки
+last_sent = {}    # (ник, вид, адресат) -> время последней отправки
+pending_lock = threading.Lock()
+
+def send(conn, data):
+    writer = writers.get(conn)
+    if writer is None:
+        return
+    try:
+        writer.send(data)
+    except:
+        pass
+
+def negotiate(conn, reader, frame):
+    # Ответ на hello уходит несжатым, дальше сжимаются оба направления
+    compress = COMPRESSION in frame.get("compress", [])
+    welcome = encode_frame({"type": "welcome", "compress": COMPRESSION if compress else None})
+    if compress:
+        writers[conn].send_then_compress(welcome)
+        reader.enable_compression()
+    else:
+        send(conn, welcome)
+    # Ретранслировать соединению можно только после того, как оно узнало о сжатии
+    clients.append(conn)
+
+def queue_event(key, frame):
+    with pending_lock:
+        pending[key] = frame
+
+def handle_hello(conn, frame):
+    nick = frame.get("nick")
+    if not nick:
+        return
+    with state_lock:
+        conn_nicks[conn] = nick
+        nick_conns[nick] = conn
+        friends[nick] = set(frame.get("friends", []))
+        snapshot = {f: presence[f] for f in friends[nick] if f in presence}
+    subscribe(conn, frame.get("chats", []))
+    # Новому клиенту сразу отдаём состояние друзей одним кадром
+    send(conn, encode_frame({"type": "presence_batch", "states": snapshot}))
+    if frame.get("state"):
+        handle_presence(conn, frame)
+
+def handle_presence(conn, frame):
+    nick = conn_nicks.get(conn)
+    state = frame.get("state")
+    if not nick or state not in PRESENCE_STATES:
+        return
+    with state_lock:
+        if state == "offline":
+            presence.pop(nick, None)
+        else:
+            presence[nick] = state
+    queue_event((nick, "presence", None), {"type": "presence", "nick": nick, "state": state})
+
+def handle_typing(conn, frame):
+    nick = conn_nicks.get(conn)
+    target = frame.get("to")
+    if not nick or not target:
+        return
+    queue_event((nick, "typing", target), {"type": "typing", "from": nick, "typing": bool(frame.get("typing"))})
+
+def subscribe(conn, chat_ids):
+    with state_lock:
+        for chat_id in chat_ids:
+            subscribers.setdefault(chat_id, set()).add(conn)
+            conn_chats.setdefault(conn, set()).add(chat_id)
+
+def handle_subscribe(conn, frame):
+    subscribe(conn, frame.get("chats", []))
+
+def handle_message(conn, frame, line):
+    # Один проход по подписчикам переписки, кадр кодируется один раз
+    with state_lock:
+        targets = list(subscribers.get(frame.get("chat"), ()))
+    for c in targets:
+        if c != conn:
+            send(c, line)
+
+def handle_invite(conn, frame, line):
+    chat_id = frame.get("chat")
+    if not chat_id:
+        return
+    with state_lock:
+        members = [nick_conns[m] for m in frame.get("members", []) if m in nick_conns]
+    for c in members:
+        subscribe(c, [chat_id])
+        if c != conn:
+            send(c, line)
+
+def handle_receipts(conn, frame):
+    # Пачку курсоров раскладываем по получателям: каждый видит только свои переписки
+    nick = conn_nicks.get(conn)
+    cursors = frame.get("cursors")
+    if not nick or not isinstance(cursors, dict):
+        return
+    per_conn = {}
+    with state_lock:
+        for chat_id, upto in cursors.items():
+            for c in subscribers.get(chat_id, ()):
+                if c != conn:
+                    per_conn.setdefault(c, {})[chat_id] = upto
+    for c, chat_cursors in per_conn.items():
+        send(c, encode_frame({"type": "receipts", "from": nick, "cursors": chat_cursors}))
+
+def fan_out(key, frame):
+    nick, kind, target = key
+    with state_lock:
+        if kind == "typing":
+            targets = [target] if target in friends.get(nick, ()) else []
+        else:
+            targets = list(friends.get(nick, ()))
+        conns = [nick_conns[t] for t in targets if t in nick_conns]
+    data = encode_frame(frame)
+    for c in conns:
+        send(c, data)
+
+def flush_loop():
+    last_prune = time.monotonic()
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        now = time.monotonic()
+        ready = []
+        with pending_lock:
+            for key, frame in list(pending.items()):
+                if now - last_sent.get(key, 0) >= MIN_INTERVAL[key[1]]:
+                    ready.append((key, frame))
+                    del pending[key]
+                    last_sent[key] = now
+            # Запись старше своего интервала уже ничего не ограничивает
+            if now - last_prune >= PRUNE_INTERVAL:
+                last_prune = now
+                for key, sent in list(last_sent.items()):
+                    if now - sent >= MIN_INTERVAL[key[1]]:
+                        del last_sent[key]
+        for key, frame in ready:
+            fan_out(key, frame)
+
+def relay(conn, data):
+    # ретранслируем полученные данные всем клиентам кроме отправителя
+    for c in list(clients):
+        if c != conn:
+            send(c, data)
+
+HANDLERS = {
+    "hello": handle_hello,
+    "presence": handle_presence,
+    "typing": handle_typing,
+    "subscribe": handle_subscribe,
+    "receipts": handle_receipts,
+}
+
+# Эти кадры пересылаются как есть, поэтому обработчик получает и исходную строку
+RELAY_HANDLERS = {
+    "message": handle_message,
+    "invite": handle_invite,
+}
+
+def disconnect(conn):
+    with state_lock:
+        for chat_id in conn_chats.pop(conn, ()):
+            members = subscribers.get(chat_id)
+            if members is not None:
+                members.discard(conn)
+                if not members:
+                    del subscribers[chat_id]
+        nick = conn_nicks.pop(conn, None)
+        if nick is not None and nick_conns.get(nick) is conn:
+            del nick_conns[nick]
+            presence.pop(nick, None)
+        else:
+            nick = None
+    if nick is not None:
+        # Уход в офлайн не должен ждать окна ограничения частоты
+        with pending_lock:
+            for key in [k for k in pending if k[0] == nick and k[1] == "typing"]:
+                del pending[key]
+            for key in [k for k in last_sent if k[0] == nick]:
+                del last_sent[key]
+            pending[(nick, "presence", None)] = {"type": "presence", "nick": nick, "state": "offline"}
 
 def handle_client(conn, addr):
     print(f"Connected by {addr}")
     try:
-        while True:
-            data = conn.recv(1024)
-            if not data:
-                break
-            # ретранслируем полученные данные всем клиентам кроме отправителя
-            for c in clients:
-                if c != conn:
-                    try:
-                        c.sendall(data)
-                    except:
-                        pass
+        reader = FrameReader(conn)
+        negotiated = False
+        for line in reader:
+            frame = decode_frame(line)
+            kind = frame.get("type") if frame else None
+            if kind == "hello" and not negotiated:
+                negotiated = True
+                negotiate(conn, reader, frame)
+            if kind in HANDLERS:
+                HANDLERS[kind](conn, frame)
+            elif kind in RELAY_HANDLERS:
+                RELAY_HANDLERS[kind](conn, frame, line)
+            else:
+                relay(conn, line)
     except:
         pass
     finally:
         print(f"Disconnected {addr}")
-        clients.remove(conn)
+        disconnect(conn)
+        if conn in clients:
+            clients.remove(conn)
+        writers.pop(conn, None)
         conn.close()
 
 def main():
+    threading.Thread(target=flush_loop, daemon=True).start()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((HOST, PORT))
         s.listen()
         print(f"Server started on {HOST}:{PORT}")
         while True:
             conn, addr = s.accept()
-            clients.append(conn)
+            writers[conn] = FrameWriter(conn)
             threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+
+USERS_DB = "users.json"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Канонические строки типов, чтобы не хранить копию "text" в каждом сообщении
+MESSAGE_TYPES = {"text": "text", "image": "image"}
+
+# Таблица ников отправителей: в сообщении хранится только индекс в ней
+_sender_ids = {}
+_sender_nicks = []
+_sender_lock = threading.Lock()  # таблицу пополняют фоновые загрузки и потоки API
+
+def sender_id(nick):
+    sid = _sender_ids.get(nick)
+    if sid is None:
+        with _sender_lock:
+            sid = _sender_ids.get(nick)
+            if sid is None:
+                sid = len(_sender_nicks)
+                _sender_nicks.append(nick)
+                _sender_ids[nick] = sid
+    return sid
+
+@lru_cache(maxsize=4096)
+def _hour_start(prefix):
+    # prefix вида "2024-01-01 12"; переход на летнее время всегда на границе часа
+    return int(time.mktime(time.strptime(prefix, "%Y-%m-%d %H")))
+
+def parse_timestamp(text):
+    if not text:
+        return None
+    try:
+        minutes, seconds = int(text[14:16]), int(text[17:19])
+        return _hour_start(text[:13]) + minutes * 60 + seconds
+    except ValueError:
+        return None
+
+def now_timestamp():
+    return int(time.time())
+
+def format_timestamp(ts):
+    if ts is None:
+        return ""
+    return datetime.fromtimestamp(ts).strftime(TIME_FORMAT)
+
+class Message:
+    __slots__ = ("sender_id", "type", "body", "ts")
+
+    def __init__(self, sender, msg_type, body, ts):
+        self.sender_id = sender_id(sender)
+        self.type = MESSAGE_TYPES.get(msg_type, msg_type)
+        self.body = body  # текст сообщения или путь к файлу
+        self.ts = ts  # секунды от эпохи или None
+
+    @property
+    def sender(self):
+        return _sender_nicks[self.sender_id]
+
+    @property
+    def timestamp(self):
+        return format_timestamp(self.ts)
+
+    @property
+    def text(self):
+        return self.body if self.type == "text" else ""
+
+    @property
+    def file(self):
+        return self.body if self.type == "image" else ""
+
+    @classmethod
+    def from_dict(cls, data):
+        msg_type = data.get("type", "text")
+        body = data.get("file", "") if msg_type == "image" else data.get("text", "")
+        return cls(data.get("sender", ""), msg_type, body, parse_timestamp(data.get("timestamp", "")))
+
+    def matches(self, data):
+        msg_type = data.get("type", "text")
+        body = data.get("file", "") if msg_type == "image" else data.get("text", "")
+        return (
+            self.sender == data.get("sender", "")
+            and self.type == msg_type
+            and self.body == body
+            and self.ts == parse_timestamp(data.get("timestamp", ""))
+        )
+
+    def to_dict(self):
+        data = {"sender": self.sender, "type": self.type}
+        data["file" if self.type == "image" else "text"] = self.body
+        data["timestamp"] = self.timestamp
+        return data
+
+def is_message_dict(data):
+    # Кадры от других клиентов проверяем до разбора: from_dict рассчитан на строки
+    if not isinstance(data, dict):
+        return False
+    fields = ("sender", "type", "file" if data.get("type") == "image" else "text", "timestamp")
+    return all(isinstance(data.get(f), str) for f in fields)
+
+def messages_from_disk(users):
+    # Одна и та же переписка лежит у обоих собеседников: второй получает
+    # те же объекты Message, а не свои копии
+    shared = {}
+    for user in users.values():
+        messages = user.get("messages")
+        if not messages:
+            continue
+        for key, history in messages.items():
+            first = shared.get(key)
+            converted = []
+            for i, raw in enumerate(history):
+                if first is not None and i < len(first) and first[i].matches(raw):
+                    converted.append(first[i])
+                else:
+                    converted.append(Message.from_dict(raw))
+            if first is None:
+                shared[key] = converted
+            messages[key] = converted
+    return users
+
+def messages_to_disk(users):
+    cache = {}
+    result = {}
+    for email, user in users.items():
+        data = dict(user)
+        messages = user.get("messages")
+        if messages:
+            data["messages"] = {}
+            for key, history in messages.items():
+                raw_history = []
+                for msg in history:
+                    raw = cache.get(id(msg))
+                    if raw is None:
+                        raw = cache[id(msg)] = msg.to_dict()
+                    raw_history.append(raw)
+                data["messages"][key] = raw_history
+        result[email] = data
+    return result
+
+def file_stamp(path):
+    # Одного mtime мало: он грубый, а после os.replace у файла новый inode
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+def write_json_atomic(path, data):
+    # Другие процессы перечитывают файл по опросу и не должны застать его недописанным
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def users_mtime():
+    try:
+        return os.path.getmtime(USERS_DB)
+    except OSError:
+        return None
+
+def load_users():
+    try:
+        with open(USERS_DB, "r", encoding="utf-8") as f:
+            return messages_from_disk(json.load(f))
+    except Exception:
+        return {}
+
+def save_users(users):
+    try:
+        data = messages_to_disk(users)
+        with open(USERS_DB, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+    except Exception as e:
+        print(f"Ошибка при сохранении users.json: {e}")
+
+def nick_index(users):
+    return {u.get("nick"): email for email, u in users.items()}
+
+def generate_nick(name):
+    digits = f"{random.randint(0,9999):04}"
+    return f"{name}#{digits}"
+
+def get_chat_key(nick1, nick2):
+    return "|".join(sorted([nick1, nick2]))